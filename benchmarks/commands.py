@@ -0,0 +1,65 @@
+"""
+    Commands per second of EsspApi over a loopback serial port: no device and no line delays,
+    so only the cost of building, checking and parsing the packets is measured.
+
+    Usage: python benchmarks/commands.py [seconds per command]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+from essp_api import EsspApi
+
+OK_RESPONSE = bytes(bytearray.fromhex('7f8001f02380'))
+POLL_RESPONSE = bytes(bytearray.fromhex('7f8003f0ef04d44a'))
+
+
+class LoopbackSerial(object):
+    def __init__(self, *args, **kwargs):
+        self.response = b''
+
+    def write(self, data):
+        self.response = POLL_RESPONSE if bytearray(data)[3] == 7 else OK_RESPONSE
+
+    def read(self, count=1):
+        res, self.response = self.response[:count], self.response[count:]
+        return res
+
+    def inWaiting(self):
+        return len(self.response)
+
+    @property
+    def in_waiting(self):
+        return len(self.response)
+
+
+def bench(func, seconds):
+    count = 0
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        for i in range(100):
+            func()
+        count += 100
+    return count / (time.time() - start)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    serial.Serial = LoopbackSerial
+    essp = EsspApi('loopback')
+    cases = (
+        ('poll', essp.poll),
+        ('hold', essp.hold),
+        ('set_inhibits', lambda: essp.set_inhibits(0x7f, 0)),
+    )
+    sys.stdout.write('Python %s\n' % sys.version.split()[0])
+    for name, func in cases:
+        sys.stdout.write('%-14s %10.0f commands/s\n' % (name, bench(func, seconds)))
+
+
+if __name__ == '__main__':
+    main()
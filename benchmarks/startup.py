@@ -0,0 +1,42 @@
+"""
+    Startup time of kiosk_server subcommands, each run in a fresh interpreter.
+
+    Usage: python benchmarks/startup.py [runs]
+"""
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KIOSK_SERVER = os.path.join(ROOT, 'kiosk_server.py')
+MISSING_PIDFILE = os.path.join(ROOT, 'benchmarks', 'missing.pid')
+
+
+def measure(args, runs):
+    times = []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable] + args, stdout=devnull, stderr=devnull, env=env)
+            times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    cases = (
+        ('python -c pass', ['-c', 'pass']),
+        ('import essp_api', ['-c', 'import essp_api']),
+        ('kiosk_server --help', [KIOSK_SERVER, '--help']),
+        ('kiosk_server stop', [KIOSK_SERVER, 'stop', '-p', MISSING_PIDFILE]),
+    )
+    sys.stdout.write('Python %s, %s runs\n' % (sys.version.split()[0], runs))
+    for name, args in cases:
+        best, avg = measure(args, runs)
+        sys.stdout.write('%-20s best %6.1f ms  avg %6.1f ms\n' % (name, best * 1000, avg * 1000))
+
+
+if __name__ == '__main__':
+    main()
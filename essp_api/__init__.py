@@ -1 +1,3 @@
-from essp_api.api import EsspApi
\ No newline at end of file
+from essp_api.api import EsspApi
+from essp_api.channels import ChannelConfig
+from essp_api.payout import PayoutInventory
@@ -1,6 +1,51 @@
 import serial
 import logging
 import time
+from essp_api.channels import ChannelConfig
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            crc = ((crc << 1) & 0xffff) ^ 0x8005 if crc & 0x8000 else (crc << 1) & 0xffff
+        table.append(crc)
+    return tuple(table)
+
+
+CRC_TABLE = _crc_table()
+
+# Reasons for the latest rejected banknote (EsspApi.last_reject)
+REJECT_REASONS = {
+    0x00: 'Note Accepted',
+    0x01: 'Note length incorrect',
+    0x02: 'Reject reason 2',
+    0x03: 'Reject reason 3',
+    0x04: 'Reject reason 4',
+    0x05: 'Reject reason 5',
+    0x06: 'Channel Inhibited',
+    0x07: 'Second Note Inserted',
+    0x08: 'Reject reason 8',
+    0x09: 'Note recognised in more than one channel',
+    0x0A: 'Reject reason 10',
+    0x0B: 'Note too long',
+    0x0C: 'Reject reason 12',
+    0x0D: 'Mechanism Slow / Stalled',
+    0x0E: 'Striming Attempt',
+    0x0F: 'Fraud Channel Reject',
+    0x10: 'No Notes Inserted',
+    0x11: 'Peak Detect Fail',
+    0x12: 'Twisted note detected',
+    0x13: 'Escrow time-out',
+    0x14: 'Bar code scan fail',
+    0x15: 'Rear sensor 2 Fail',
+    0x16: 'Slot Fail 1',
+    0x17: 'Slot Fail 2',
+    0x18: 'Lens Over Sample',
+    0x19: 'Width Detect Fail',
+    0x1A: 'Short Note Detected',
+}
 
 
 class ESSPException(Exception):
@@ -19,11 +64,9 @@ class SerialNull(object):
 
     @staticmethod
     def read(*args, **kwargs):
-        return ''
+        return b''
 
-    @staticmethod
-    def inWaiting(*args, **kwargs):
-        return 0
+    in_waiting = 0
 
 
 class EsspApi(object):
@@ -44,7 +87,52 @@ class EsspApi(object):
     COMMAND_NOT_PROCESSED = 0xF5  # 245
     UNKNOWN_COMMAND = 0xF2  # 242
 
+    # Payout devices (SMART Payout, NV11), protocol version 6
+    DISPENSING = 0xDA
+    DISPENSED = 0xD2
+    JAMMED = 0xD5
+    HALTED = 0xD6
+    FLOATING = 0xD7
+    FLOATED = 0xD8
+    TIMEOUT = 0xD9
+    INCOMPLETE_PAYOUT = 0xDC
+    INCOMPLETE_FLOAT = 0xDD
+    CASHBOX_PAID = 0xDE
+    NOTE_STORED_IN_PAYOUT = 0xDB
+    EMPTYING = 0xC2
+    EMPTIED = 0xC3
+    SMART_EMPTYING = 0xB3
+    SMART_EMPTIED = 0xB4
+    NOTE_TRANSFERED_TO_STACKER = 0xC9
+    NOTE_HELD_IN_BEZEL = 0xCE
+    NOTE_PAID_INTO_STORE_AT_POWERUP = 0xCB
+    NOTE_PAID_INTO_STACKER_AT_POWERUP = 0xCA
+    NOTE_DISPENSED_AT_POWERUP = 0xCD
+    NOTE_FLOAT_REMOVED = 0xC7
+    NOTE_FLOAT_ATTACHED = 0xC8
+    DEVICE_FULL = 0xCF
+
+    PAYOUT_ROUTE = 0
+    CASHBOX_ROUTE = 1
+
     two_parameters_status = (READ_NOTE, CREDIT_NOTE, FRAUD_ATTEMPT, NOTE_CLEARED_FROM_RESET, NOTE_CLEARED_INTO_CASHBOX)
+    # param: [(value, country), ...]
+    values_status = (DISPENSING, DISPENSED, JAMMED, HALTED, FLOATING, FLOATED, TIMEOUT, CASHBOX_PAID,
+                     SMART_EMPTYING, SMART_EMPTIED)
+    # param: [(dispensed value, requested value, country), ...]
+    incomplete_status = (INCOMPLETE_PAYOUT, INCOMPLETE_FLOAT)
+    # param: (value, country)
+    value_status = (NOTE_TRANSFERED_TO_STACKER, NOTE_HELD_IN_BEZEL, NOTE_PAID_INTO_STORE_AT_POWERUP,
+                    NOTE_PAID_INTO_STACKER_AT_POWERUP, NOTE_DISPENSED_AT_POWERUP)
+
+    # Commands allowed in a batch and the ones sent only once when repeated in a row
+    batch_commands = ('reset', 'set_inhibits', 'display_on', 'display_off', 'setup_request', 'host_protocol_version',
+                      'poll', 'reject_note', 'disable', 'enable', 'serial_number', 'unit_data', 'channel_values',
+                      'channel_security', 'sync', 'last_reject', 'hold', 'enable_higher_protocol',
+                      'get_all_levels', 'get_note_positions', 'enable_payout', 'disable_payout', 'halt_payout',
+                      'empty_all', 'smart_empty', 'payout_note', 'stack_note')
+    coalesced_commands = ('display_on', 'display_off', 'disable', 'enable', 'sync', 'hold', 'enable_higher_protocol',
+                          'enable_payout', 'disable_payout')
 
     _logger = None
     _serialport = None
@@ -85,6 +173,12 @@ class EsspApi(object):
         self._logger.info('[ESSP][cmd] Set inhibits')
         return self._simple_cmd([2, low_channels, high_channels])
 
+    def set_channel_inhibits(self, config):
+        """
+            Sends the inhibit mask of a ChannelConfig
+        """
+        return self.set_inhibits(*config.inhibit_bytes())
+
     def display_on(self):
         self._logger.info('[ESSP][cmd] Display on')
         result = self._send(3)
@@ -129,13 +223,24 @@ class EsspApi(object):
         except ESSPException:
             return poll_data
 
-        result.reverse()
-        while len(result):
-            c = result.pop()
-            if c in self.two_parameters_status:
-                param = result.pop()
-            else:
-                param = None
+        two_parameters_status = self.two_parameters_status
+        i = 0
+        size = len(result)
+        while i < size:
+            c = result[i]
+            i += 1
+            param = None
+            if c in two_parameters_status:
+                if i < size:
+                    param = result[i]
+                    i += 1
+            elif c in self.values_status:
+                param, i = self._parse_values(result, i, 7)
+            elif c in self.incomplete_status:
+                param, i = self._parse_values(result, i, 11)
+            elif c in self.value_status:
+                param = self._parse_value(result[i:i + 7])
+                i += 7
             poll_data.append({
                 'status': c,
                 'param': param
@@ -189,12 +294,18 @@ class EsspApi(object):
             Returns the real values of the channels
         """
         try:
-            result = self._send('e')
+            result = self._send(0xE)
             channels = result[0]
         except (ESSPException, IndexError):
             return []
-        unitdata = self.unit_data()
-        return [result[1 + i] * unitdata[3] for i in range(0, channels)]
+        multiplier = self.unit_data()[3]
+        return [v * multiplier for v in result[1:1 + channels]]
+
+    def channel_config(self):
+        """
+            Returns a ChannelConfig with the real values of the channels, all channels accepted
+        """
+        return ChannelConfig(self.channel_values())
 
     def channel_security(self):
         # Returns the security settings of all channels
@@ -214,38 +325,17 @@ class EsspApi(object):
         return self._simple_cmd(0x11)
 
     def last_reject(self):
-        # Get reson for latest rejected banknote
-        # 0x00 = Note Accepted
-        # 0x01 = Note length incorrect
-        # 0x02 = Reject reason 2
-        # 0x03 = Reject reason 3
-        # 0x04 = Reject reason 4
-        # 0x05 = Reject reason 5
-        # 0x06 = Channel Inhibited
-        # 0x07 = Second Note Inserted
-        # 0x08 = Reject reason 8
-        # 0x09 = Note recognised in more than one channel
-        # 0x0A = Reject reason 10
-        # 0x0B = Note too long
-        # 0x0C = Reject reason 12
-        # 0x0D = Mechanism Slow / Stalled
-        # 0x0E = Striming Attempt
-        # 0x0F = Fraud Channel Reject
-        # 0x10 = No Notes Inserted
-        # 0x11 = Peak Detect Fail
-        # 0x12 = Twisted note detected
-        # 0x13 = Escrow time-out
-        # 0x14 = Bar code scan fail
-        # 0x15 = Rear sensor 2 Fail
-        # 0x16 = Slot Fail 1
-        # 0x17 = Slot Fail 2
-        # 0x18 = Lens Over Sample
-        # 0x19 = Width Detect Fail
-        # 0x1A = Short Note Detected
+        """
+            Returns the reason code of the latest rejected banknote (see REJECT_REASONS), None on error
+        """
         try:
             return self._send(0x17)[0]
         except (ESSPException, IndexError):
-            return 0
+            return None
+
+    @staticmethod
+    def reject_reason(code):
+        return REJECT_REASONS.get(code, 'Unknown reason 0x%02x' % code)
 
     def hold(self):
         self._logger.info('[ESSP][cmd] Hold')
@@ -255,6 +345,142 @@ class EsspApi(object):
         # Enables functions from implemented with version >= 3
         return self._simple_cmd(0x19)
 
+    def batch(self, commands):
+        """
+            Runs several commands in one go, e.g. [('set_inhibits', 'ff', '0'), 'enable'].
+            A command repeating the previous one is not sent again, it gets the previous result.
+            Returns a list with a result for each command (False for unknown ones)
+        """
+        results = []
+        last = None
+        for command in commands:
+            if not isinstance(command, (list, tuple)):
+                command = (command,)
+            name, args = command[0], tuple(command[1:])
+            if name not in self.batch_commands:
+                results.append(False)
+                last = None
+                continue
+            if (name, args) == last and name in self.coalesced_commands:
+                self._logger.debug('[ESSP] Coalesced %s' % name)
+                results.append(results[-1])
+                continue
+            results.append(getattr(self, name)(*args))
+            last = (name, args)
+        return results
+
+    def set_denomination_route(self, value, country, payout=True):
+        """
+            Routes the notes of this value to the payout store (payout=True) or to the cashbox
+        """
+        self._logger.info('[ESSP][cmd] Route %s %s to %s' % (value, country, 'payout' if payout else 'cashbox'))
+        route = self.PAYOUT_ROUTE if payout else self.CASHBOX_ROUTE
+        return self._simple_cmd([0x3B, route, self._le_bytes(value, 4), self._country(country)])
+
+    def get_denomination_route(self, value, country):
+        """
+            Returns PAYOUT_ROUTE, CASHBOX_ROUTE or None on error
+        """
+        try:
+            return self._send([0x3C, self._le_bytes(value, 4), self._country(country)])[0]
+        except (ESSPException, IndexError):
+            return None
+
+    def get_all_levels(self):
+        """
+            Returns the notes stored for payout: [{'value': .., 'country': .., 'level': ..}, ...],
+            None on error
+        """
+        try:
+            result = self._send(0x22)
+            if len(result) < 1 + result[0] * 9:
+                return None
+            levels = []
+            for i in range(1, 1 + result[0] * 9, 9):
+                value, country = self._parse_value(result[i + 2:i + 9])
+                levels.append({'value': value, 'country': country, 'level': self._le_to_int(result[i:i + 2])})
+            return levels
+        except (ESSPException, IndexError):
+            return None
+
+    def get_denomination_level(self, value, country):
+        """
+            Returns the number of notes of this value stored for payout, None on error
+        """
+        try:
+            result = self._send([0x35, self._le_bytes(value, 4), self._country(country)])
+            if len(result) < 2:
+                return None
+            return self._le_to_int(result[0:2])
+        except (ESSPException, IndexError):
+            return None
+
+    def set_denomination_level(self, value, country, level):
+        """
+            Adds `level` notes of this value to the stored level (SMART Hopper / SMART Payout)
+        """
+        return self._simple_cmd([0x34, self._le_bytes(level, 2), self._le_bytes(value, 4), self._country(country)])
+
+    def get_note_positions(self):
+        """
+            NV11: returns the values (or channels, depending on the value reporting) of the stored notes,
+            the last stored one first
+        """
+        try:
+            result = self._send(0x41)
+            count = result[0]
+            if len(result) == 1 + count:
+                return result[1:]
+            return [self._le_to_int(result[i:i + 4]) for i in range(1, 1 + count * 4, 4)]
+        except (ESSPException, IndexError):
+            return []
+
+    def payout_amount(self, amount, country, test=False):
+        """
+            Pays the amount (in the lowest currency unit) from the payout store.
+            With test=True the device only checks that the payout is possible
+        """
+        self._logger.info('[ESSP][cmd] Payout %s %s%s' % (amount, country, ' (test)' if test else ''))
+        return self._simple_cmd([0x33, self._le_bytes(amount, 4), self._country(country), 0x19 if test else 0x58])
+
+    def float_amount(self, min_payout, amount, country, test=False):
+        """
+            Moves notes to the cashbox leaving `amount` in the payout store
+        """
+        self._logger.info('[ESSP][cmd] Float %s %s' % (amount, country))
+        return self._simple_cmd([0x3D, self._le_bytes(min_payout, 2), self._le_bytes(amount, 4),
+                                 self._country(country), 0x19 if test else 0x58])
+
+    def halt_payout(self):
+        self._logger.info('[ESSP][cmd] Halt payout')
+        return self._simple_cmd(0x38)
+
+    def empty_all(self):
+        self._logger.info('[ESSP][cmd] Empty all')
+        return self._simple_cmd(0x3F)
+
+    def smart_empty(self):
+        self._logger.info('[ESSP][cmd] Smart empty')
+        return self._simple_cmd(0x52)
+
+    def enable_payout(self):
+        self._logger.info('[ESSP][cmd] Enable payout')
+        return self._simple_cmd(0x5C)
+
+    def disable_payout(self):
+        self._logger.info('[ESSP][cmd] Disable payout')
+        return self._simple_cmd(0x5B)
+
+    def payout_note(self):
+        # NV11: pays out the last stored note
+        self._logger.info('[ESSP][cmd] Payout note')
+        return self._simple_cmd(0x42)
+
+    def stack_note(self):
+        # NV11: moves the last stored note to the cashbox
+        self._logger.info('[ESSP][cmd] Stack note')
+        return self._simple_cmd(0x43)
+
     def _simple_cmd(self, cmd):
         try:
             self._send(cmd)
@@ -264,42 +490,46 @@ class EsspApi(object):
 
     def _getseq(self):
         self._sequence = not self._sequence
-        return '%02x' % (self._id | 0x80 if self._sequence else 0)
+        return self._id | (0x80 if self._sequence else 0)
 
     @staticmethod
-    def _crc(command):
-        seed = 0xffff
-        poly = 0x8005
-        crc = seed
-        for cmd in command:
-            crc ^= int(cmd, 16) << 8
-            for j in range(0, 8):
-                if crc & 0x8000:
-                    crc = ((crc << 1) & 0xffff) ^ poly
-                else:
-                    crc <<= 1
-        return [('%02x' % (crc & 0xff)).lower(), ('%02x' % ((crc >> 8) & 0xff)).lower()]
-
-    def _send(self, commands):
-        if isinstance(commands, (list, tuple)):
-            data = commands[:]
-        else:
-            data = [commands]
-        data = ['%02x' % c if isinstance(c, int) else c for c in data]
-        data.insert(0, '%02x' % len(data))
-        data.insert(0, self._getseq())
+    def _crc(data):
+        """
+            Returns the CRC16 (poly 0x8005, seed 0xffff) of the bytes as two bytes, low byte first
+        """
+        crc = 0xffff
+        for c in data:
+            crc = ((crc << 8) & 0xffff) ^ CRC_TABLE[(crc >> 8) ^ c]
+        return bytes((crc & 0xff, crc >> 8))
 
-        data += self._crc(data)
+    @staticmethod
+    def _encode(commands):
+        """
+            Packs a command and its parameters into bytes. Parameters can be ints,
+            bytes or (for backward compatibility) hex strings like the easy_inhibit result
+        """
+        if not isinstance(commands, (list, tuple)):
+            commands = (commands,)
+        data = bytearray()
+        for c in commands:
+            if isinstance(c, int):
+                data.append(c)
+            elif isinstance(c, (bytes, bytearray)):
+                data += c
+            else:
+                data.append(int(c, 16))
+        return data
 
-        request = ['7f']
-        for c in data:
-            request.append('%02x' % int(c, 16))
-            if c == '7f':
-                request.append(c)
+    def _send(self, commands):
+        data = self._encode(commands)
+        packet = bytearray((self._getseq(), len(data))) + data
+        packet += self._crc(packet)
+        request = b'\x7f' + bytes(packet.replace(b'\x7f', b'\x7f\x7f'))
 
-        self._logger.debug('[ESSP] SEND: ' + ' '.join(request))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('[ESSP] SEND: ' + ' '.join('%02x' % c for c in request))
 
-        self._send_2tries(''.join(request).decode('hex'))
+        self._send_2tries(request)
 
         return self._read()
 
@@ -313,25 +543,22 @@ class EsspApi(object):
                 return
         raise ESSPException
 
-    def _read_chars(self, count=1):
-            return [ord(c) for c in self._device.read(count)]
-
     def _read(self):
-        response = []
+        response = bytearray()
         step = 0
         waiting_chars = 1
         timeout = time.time() + 1.1
         while time.time() < timeout:
-            ready_chars = self._device.inWaiting()
-            if ready_chars < waiting_chars:
+            device = self._device
+            if device.in_waiting < waiting_chars:
                 time.sleep(0.01)
                 continue
-            chars = self._read_chars(waiting_chars)
+            chars = device.read(waiting_chars)
 
             if step == 0:
                 if chars[0] != 0x7f:
                     continue
-                response = chars
+                response = bytearray(chars)
                 waiting_chars = 2
                 step = 1
                 continue
@@ -343,34 +570,67 @@ class EsspApi(object):
                 step = 2
                 continue
 
-            response = [('%02x' % c).lower() for c in response]
-
-            self._logger.debug('[ESSP] RECV: ' + ' '.join(response))
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('[ESSP] RECV: ' + ' '.join('%02x' % c for c in response))
 
             crc = self._crc(response[1:-2])
             if crc != response[-2:]:
-                self._logger.warn('[ESSP] RECV: ' + ' '.join(response))
-                self._logger.warn('[ESSP] Failed to verify crc: ' + str(crc))
+                self._logger.warning('[ESSP] RECV: ' + ' '.join('%02x' % c for c in response))
+                self._logger.warning('[ESSP] Failed to verify crc: ' + crc.hex())
 
             if len(response) < 6:
                 raise ESSPException()
-            response = [int(c, 16) for c in response]
             if response[3] != 0xf0:
                 self._logger.info('[ESSP] Error 0x%02x' % response[3])
                 raise ESSPException()
-            return response[4:-2]
+            return list(response[4:-2])
 
         self._serial = None
         raise ESSPException()
 
     @staticmethod
     def easy_inhibit(acceptmask):
-        bitmask = int('00000000', 2)
+        bitmask = 0
         for i, val in enumerate(acceptmask):
             if val:
-                bitmask += pow(2, i)
+                bitmask |= 1 << i
         return '%02x' % bitmask
 
+    @staticmethod
+    def _le_bytes(value, size):
+        return bytes((value >> (8 * i)) & 0xff for i in range(size))
+
+    @staticmethod
+    def _le_to_int(data):
+        return int.from_bytes(bytes(data), 'little')
+
+    @staticmethod
+    def _country(country):
+        return country if isinstance(country, bytes) else country.encode('ascii')
+
+    @classmethod
+    def _parse_value(cls, data):
+        return cls._le_to_int(data[0:4]), bytes(data[4:7]).decode('ascii', 'replace')
+
+    @classmethod
+    def _parse_values(cls, data, i, size):
+        """
+            Parses a counted list of value records (7 bytes: value, country or
+            11 bytes: dispensed, requested, country) starting at data[i].
+            Returns the list and the index after it
+        """
+        values = []
+        count = data[i] if i < len(data) else 0
+        i += 1
+        for j in range(count):
+            record = data[i:i + size]
+            if size == 11:
+                values.append((cls._le_to_int(record[0:4]),) + cls._parse_value(record[4:11]))
+            else:
+                values.append(cls._parse_value(record))
+            i += size
+        return values, i
+
     @staticmethod
     def _list_to_int(data):
         res = 0
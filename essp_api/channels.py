@@ -0,0 +1,109 @@
+_numpy = False
+
+
+def get_numpy():
+    """
+        Returns the numpy module or None if it is not installed.
+        It is imported on first use: numpy takes longer to load than the rest of the package
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+
+class ChannelConfig(object):
+    """
+        Channel values and inhibit mask of a validator.
+        Channels are numbered from 1 like in the poll events, channel 0 means "unknown yet" and is worth 0
+    """
+    MAX_CHANNELS = 16
+
+    values = None
+    mask = 0
+    _value_table = None
+    _value_array = None
+
+    def __init__(self, values, multiplier=1, mask=None):
+        self.values = tuple(v * multiplier for v in values[:self.MAX_CHANNELS])
+        self._value_table = (0,) + self.values
+        self.mask = (1 << len(self.values)) - 1 if mask is None else mask
+
+    @classmethod
+    def from_setup(cls, setup):
+        """
+            Builds the config from the EsspApi.setup_request() result
+        """
+        return cls(setup['values'], setup['multiplier'])
+
+    @property
+    def channels(self):
+        return len(self.values)
+
+    def value(self, channel):
+        if 0 < channel < len(self._value_table):
+            return self._value_table[channel]
+        return 0
+
+    def is_enabled(self, channel):
+        return channel > 0 and bool(self.mask >> (channel - 1) & 1)
+
+    def enable(self, *channels):
+        for channel in channels:
+            self.mask |= self._bit(channel)
+
+    def inhibit(self, *channels):
+        for channel in channels:
+            self.mask &= ~self._bit(channel)
+
+    def _bit(self, channel):
+        if not 0 < channel <= self.MAX_CHANNELS:
+            raise ValueError('Channels are numbered from 1 to %s, got %s' % (self.MAX_CHANNELS, channel))
+        return 1 << (channel - 1)
+
+    def set_flags(self, acceptmask):
+        """
+            Sets the mask from a list of flags, e.g. [1, 0, 1] accepts channels 1 and 3
+        """
+        self.mask = 0
+        for i, val in enumerate(acceptmask):
+            if val:
+                self.mask |= 1 << i
+
+    def inhibit_bytes(self):
+        """
+            Returns (low_channels, high_channels) as ints for EsspApi.set_inhibits
+        """
+        return self.mask & 0xff, (self.mask >> 8) & 0xff
+
+    def values_array(self):
+        """
+            Returns the value table as a NumPy array indexed by channel (requires numpy)
+        """
+        if self._value_array is None:
+            numpy = get_numpy()
+            if numpy is None:
+                raise ImportError('numpy is required for the array form of the value table')
+            self._value_array = numpy.array(self._value_table, dtype=numpy.int64)
+        return self._value_array
+
+    def values_of(self, channels):
+        """
+            Returns the values of a sequence of channels, as a NumPy array if numpy is available
+        """
+        numpy = get_numpy()
+        if numpy is not None:
+            channels = numpy.asarray(channels, dtype=numpy.intp)
+            channels = numpy.where((channels > 0) & (channels < len(self._value_table)), channels, 0)
+            return self.values_array()[channels]
+        return [self.value(c) for c in channels]
+
+    def total(self, channels):
+        """
+            Returns the sum of the values of a sequence of channels
+        """
+        values = self.values_of(channels)
+        return int(sum(values) if isinstance(values, list) else values.sum())
@@ -0,0 +1,105 @@
+from essp_api.api import EsspApi
+
+
+class PayoutInventory(object):
+    """
+        Notes held by a payout device (SMART Payout, NV11) per value, kept up to date from the poll events
+        so the levels are not asked again after every transaction.
+        When an event can't be accounted for (jam, halted or incomplete payout, reset, ...) the inventory
+        becomes stale and should be refreshed from the device
+    """
+    channels = None
+    country = None
+    stale = True
+
+    # events after which the stored notes are unknown
+    stale_status = (EsspApi.JAMMED, EsspApi.HALTED, EsspApi.TIMEOUT, EsspApi.INCOMPLETE_PAYOUT,
+                    EsspApi.INCOMPLETE_FLOAT, EsspApi.FLOATED, EsspApi.NOTE_FLOAT_REMOVED,
+                    EsspApi.NOTE_FLOAT_ATTACHED, EsspApi.SLAVE_RESET)
+
+    def __init__(self, channels, levels=None):
+        """
+            channels: ChannelConfig of the device, to know the value of a credited note
+            levels: EsspApi.get_all_levels() result
+        """
+        self.channels = channels
+        self.levels = {}
+        self._credited = None
+        if levels is not None:
+            self.set_levels(levels)
+
+    def set_levels(self, levels):
+        """
+            Sets the levels from an EsspApi.get_all_levels() result, None (an error) leaves the inventory stale
+        """
+        if levels is None:
+            self.stale = True
+            return
+        self.levels = dict((d['value'], d['level']) for d in levels if d['level'])
+        if levels:
+            self.country = levels[0]['country']
+        self.stale = False
+
+    def refresh(self, essp, force=False):
+        """
+            Asks the device for the levels if the inventory is stale (or force=True).
+            Returns False if the inventory is still stale
+        """
+        if self.stale or force:
+            self.set_levels(essp.get_all_levels())
+        return not self.stale
+
+    def level(self, value):
+        return self.levels.get(value, 0)
+
+    def total(self):
+        return sum(value * count for value, count in self.levels.items())
+
+    def update(self, events):
+        """
+            Applies the EsspApi.poll() events
+        """
+        for event in events:
+            status = event['status']
+            param = event['param']
+            if status == EsspApi.CREDIT_NOTE:
+                self._credited = self.channels.value(param)
+            elif status == EsspApi.NOTE_STORED_IN_PAYOUT:
+                if self._credited:
+                    self._add(self._credited, 1)
+                else:
+                    self.stale = True
+                self._credited = None
+            elif status == EsspApi.DISPENSED:
+                for value, country in param:
+                    self._take(value)
+            elif status in (EsspApi.NOTE_TRANSFERED_TO_STACKER, EsspApi.NOTE_DISPENSED_AT_POWERUP):
+                self._add(param[0], -1)
+            elif status == EsspApi.NOTE_PAID_INTO_STORE_AT_POWERUP:
+                self._add(param[0], 1)
+            elif status in (EsspApi.EMPTIED, EsspApi.SMART_EMPTIED):
+                self.levels = {}
+            elif status in self.stale_status:
+                self.stale = True
+
+    def _add(self, value, count):
+        level = self.levels.get(value, 0) + count
+        if level > 0:
+            self.levels[value] = level
+        else:
+            self.levels.pop(value, None)
+            if level < 0:
+                self.stale = True
+
+    def _take(self, amount):
+        """
+            Removes notes worth `amount`, the largest first. The device reports only the amount,
+            if it can't be made up of the stored notes that way the inventory is stale
+        """
+        for value in sorted(self.levels, reverse=True):
+            count = min(amount // value, self.levels[value])
+            if count:
+                self._add(value, -count)
+                amount -= value * count
+        if amount:
+            self.stale = True
@@ -0,0 +1,228 @@
+"""
+    Aggregation of acceptor events for fleet reporting.
+
+    Events are dicts like the ones kiosk_server writes to its journal (one json object per line):
+        {"time": 1500000000.0, "device": "kiosk-1", "status": 238, "param": 4}
+    A NOTE_REJECTED reason comes as a separate event with a "reason" key (see EsspApi.last_reject).
+
+    Usage:
+        python -m essp_api.report [--interval 3600] [--chunk 100000] journal1.log journal2.log ...
+"""
+import sys
+import json
+import argparse
+from collections import Counter, deque
+from essp_api.api import EsspApi
+from essp_api.channels import ChannelConfig, get_numpy
+
+
+def read_journal(path, device=None):
+    """
+        Yields the events of a journal file, lines that are not json are skipped.
+        device is set for events that have no device of their own
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            if device is not None:
+                event.setdefault('device', device)
+            yield event
+
+
+def chunks(events, size):
+    chunk = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class EventAggregator(object):
+    """
+        Totals of the events in one pass. The memory used depends on the number of channels,
+        devices and intervals, not on the number of events
+    """
+    channels = None
+    interval = None
+
+    def __init__(self, channels=None, interval=3600):
+        """
+            channels: ChannelConfig to get note values, without it only counts are meaningful
+            interval: length of the reporting intervals, seconds
+        """
+        self.channels = channels
+        self.interval = interval
+        self.events = 0
+        self.rejected = 0
+        self.channel_counts = Counter()
+        self.channel_totals = Counter()
+        self.device_counts = Counter()
+        self.device_totals = Counter()
+        self.interval_counts = Counter()
+        self.interval_totals = Counter()
+        self.reject_reasons = Counter()
+        self.frauds = Counter()
+
+    def _value(self, channel):
+        return self.channels.value(channel) if self.channels else 0
+
+    def _interval_start(self, t):
+        return int(t // self.interval * self.interval)
+
+    def add(self, event):
+        self.events += 1
+        status = event.get('status')
+        device = event.get('device')
+        if status == EsspApi.CREDIT_NOTE:
+            channel = event.get('param') or 0
+            value = self._value(channel)
+            interval = self._interval_start(event.get('time') or 0)
+            self.channel_counts[channel] += 1
+            self.channel_totals[channel] += value
+            self.device_counts[device] += 1
+            self.device_totals[device] += value
+            self.interval_counts[interval] += 1
+            self.interval_totals[interval] += value
+        elif status == EsspApi.NOTE_REJECTED:
+            self.rejected += 1
+        elif status == EsspApi.FRAUD_ATTEMPT:
+            self.frauds[device] += 1
+        if 'reason' in event:
+            self.reject_reasons[event['reason']] += 1
+
+    def add_chunk(self, events):
+        """
+            Adds a list of events, the credits are counted with numpy when it is available
+        """
+        numpy = get_numpy()
+        if numpy is None:
+            for event in events:
+                self.add(event)
+            return
+        credits = []
+        for event in events:
+            if event.get('status') == EsspApi.CREDIT_NOTE:
+                credits.append(event)
+            else:
+                self.add(event)
+        if not credits:
+            return
+        self.events += len(credits)
+        size = len(credits)
+        channels = numpy.fromiter((e.get('param') or 0 for e in credits), numpy.intp, size)
+        times = numpy.fromiter((e.get('time') or 0 for e in credits), numpy.float64, size)
+        devices = numpy.array([e.get('device') or '' for e in credits])
+        if self.channels:
+            values = self.channels.values_of(channels)
+        else:
+            values = numpy.zeros(size, dtype=numpy.int64)
+        intervals = (times // self.interval * self.interval).astype(numpy.int64)
+        self._count_array(self.channel_counts, self.channel_totals, channels, values)
+        self._count_array(self.device_counts, self.device_totals, devices, values)
+        self._count_array(self.interval_counts, self.interval_totals, intervals, values)
+
+    @staticmethod
+    def _count_array(counts, totals, keys, values):
+        numpy = get_numpy()
+        uniq, inverse = numpy.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        for key, count, total in zip(uniq.tolist(), numpy.bincount(inverse).tolist(),
+                                     numpy.bincount(inverse, weights=values).tolist()):
+            if key == '':
+                key = None
+            counts[key] += count
+            totals[key] += int(total)
+
+    def feed(self, events, chunk_size=None):
+        if chunk_size:
+            for chunk in chunks(events, chunk_size):
+                self.add_chunk(chunk)
+        else:
+            for event in events:
+                self.add(event)
+        return self
+
+    def report(self):
+        def group(counts, totals):
+            return dict((k, {'count': counts[k], 'total': totals[k]}) for k in counts)
+
+        return {
+            'events': self.events,
+            'rejected': self.rejected,
+            'channels': group(self.channel_counts, self.channel_totals),
+            'devices': group(self.device_counts, self.device_totals),
+            'intervals': group(self.interval_counts, self.interval_totals),
+            'reject_reasons': dict(self.reject_reasons),
+            'frauds': dict(self.frauds),
+        }
+
+
+class RejectStats(object):
+    """
+        Reject reason counters: totals since the start and over the last `window` notes,
+        accepted notes count in the window so the recent counts give the reject rate
+    """
+    def __init__(self, window=100):
+        self.totals = Counter()
+        self.recent_counts = Counter()
+        self.recent = deque(maxlen=window)
+
+    def add_accepted(self):
+        self._add_recent(None)
+
+    def add_rejected(self, reason):
+        self.totals[reason] += 1
+        self._add_recent(reason)
+
+    def _add_recent(self, reason):
+        if len(self.recent) == self.recent.maxlen:
+            old = self.recent[0]
+            if old is not None:
+                self.recent_counts[old] -= 1
+                if not self.recent_counts[old]:
+                    del self.recent_counts[old]
+        self.recent.append(reason)
+        if reason is not None:
+            self.recent_counts[reason] += 1
+
+    def reject_rate(self):
+        return float(sum(self.recent_counts.values())) / len(self.recent) if self.recent else 0.0
+
+    def report(self):
+        return {
+            'totals': dict((EsspApi.reject_reason(k), v) for k, v in self.totals.items()),
+            'recent': dict((EsspApi.reject_reason(k), v) for k, v in self.recent_counts.items()),
+            'notes': len(self.recent),
+            'reject_rate': self.reject_rate(),
+        }
+
+
+def aggregate(events, channels=None, interval=3600, chunk_size=None):
+    return EventAggregator(channels, interval).feed(events, chunk_size).report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Totals of kiosk_server journals')
+    parser.add_argument('journals', nargs='+', help='Journal files')
+    parser.add_argument('-i', '--interval', type=int, default=3600, help='Interval length, seconds')
+    parser.add_argument('-c', '--chunk', type=int, default=None, help='Process events in chunks of this size')
+    parser.add_argument('-V', '--values', default=None, help='Channel values, e.g. 1,5,10,20')
+    args = parser.parse_args(argv)
+    channels = ChannelConfig([int(v) for v in args.values.split(',')]) if args.values else None
+    aggregator = EventAggregator(channels, args.interval)
+    for path in args.journals:
+        aggregator.feed(read_journal(path, device=path), args.chunk)
+    json.dump(aggregator.report(), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,21 @@ import os
 import re
 import sys
 import json
-import cups
-import serial
 import atexit
-import logging
+import struct
 import argparse
-import datetime
-from signal import SIGTERM
-from wsgiref.simple_server import make_server
-from webob import Request, exc
-from time import sleep
-from multiprocessing import Process, Queue
-from essp_api import EsspApi
+from signal import signal, SIGTERM, SIGHUP
+from time import sleep, time, monotonic
+
+# cups, webob, serial, multiprocessing, logging and essp_api are imported where they are used,
+# so that stop/restart do not pay for loading them
 
 RESP_HEADERS = [('Access-Control-Allow-Origin', '*')]
+PREFLIGHT_HEADERS = RESP_HEADERS + [
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type, X-Client, X-Token, X-Timestamp, X-Signature'),
+    ('Access-Control-Max-Age', '600'),
+]
 LPR_PATH = '/usr/bin/lpr'
 PRINTER_NAME = 'CUSTOM_Engineering_VKP80'
 LOG_FILE = '/tmp/kiosk_server.log'
@@ -25,8 +26,26 @@ BIND_PORT = 8080
 BIND_ADDRESS = '127.0.0.1'
 
 HOLD_AND_WAIT_ACCEPT_CMD = False
-
-CHECK_TEMPLATE = u'''
+SERIAL_PORT = '/dev/ttyACM0'
+
+# Settings that can be overridden in the json config file (-c), reloaded on SIGHUP.
+# log_file and serialport are only read at start
+DEFAULT_CONFIG = {
+    'printer_name': PRINTER_NAME,
+    'checks_dir': CHECKS_DIR,
+    'log_file': LOG_FILE,
+    'hold_and_wait_accept_cmd': HOLD_AND_WAIT_ACCEPT_CMD,
+    'serialport': SERIAL_PORT,
+    'inhibits': [1, 1, 1, 1, 1, 1, 1],
+    'poll_interval': 1,
+    # {client id: secret}, no keys - no authentication
+    'auth_keys': {},
+    # requests per second and burst per client, 0 - no limit
+    'rate_limit': 5,
+    'rate_burst': 20,
+}
+
+CHECK_TEMPLATE = '''
 "Sistema" ltd ИНН:1401552291
 Терминал No 4565
 ул.20 Января 6
@@ -50,45 +69,267 @@ http://sistema.az
 '''
 
 
+def load_config(filename):
+    """
+        Returns DEFAULT_CONFIG updated from the json file, raises ValueError if the file is not valid
+    """
+    config = dict(DEFAULT_CONFIG)
+    if filename:
+        with open(filename) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError('%s: the config must be a json object' % filename)
+        config.update(data)
+    check_config(config)
+    return config
+
+
+def check_config(config):
+    """
+        Raises ValueError if a setting does not have the type of its default
+    """
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+    for name, default in DEFAULT_CONFIG.items():
+        value = config[name]
+        if isinstance(default, bool):
+            valid = isinstance(value, bool)
+        elif isinstance(default, (int, float)):
+            valid = is_number(value)
+        elif isinstance(default, list):
+            valid = isinstance(value, list) and len(value) <= 16 and all(v in (0, 1) for v in value)
+        elif isinstance(default, dict):
+            valid = isinstance(value, dict) and all(isinstance(k, str) and isinstance(v, str)
+                                                    for k, v in value.items())
+        else:
+            valid = isinstance(value, type(default))
+        if not valid:
+            raise ValueError('invalid config value of %s: %r' % (name, value))
+    if config['rate_limit'] and config['rate_burst'] < 1:
+        raise ValueError('rate_burst must be at least 1 with a rate_limit')
+
+
+class Authenticator(object):
+    """
+        Checks the X-Client header and either X-Token (the client secret) or X-Signature:
+        hex HMAC-SHA256 with the client secret of the method, the path with the query string,
+        the X-Timestamp header and the hex SHA-256 of the body, joined with newlines.
+        The HMAC objects are keyed once, each request only copies one.
+        A signature is accepted once: the ones seen in the last 2 * MAX_SKEW seconds are remembered,
+        older ones are refused by the timestamp check. A token can be replayed, send it over trusted links only
+    """
+    MAX_SKEW = 300
+
+    def __init__(self, keys):
+        import hmac
+        import hashlib
+        from collections import deque
+        self.keys = dict(keys)
+        self.secrets = dict((client, key.encode('utf8')) for client, key in keys.items())
+        self.macs = dict((client, hmac.new(key, digestmod=hashlib.sha256)) for client, key in self.secrets.items())
+        self.seen = set()
+        self.seen_order = deque()
+
+    def check(self, req):
+        """
+            Returns the client id or None
+        """
+        import hmac
+        import hashlib
+        client = req.headers.get('X-Client')
+        if client not in self.macs:
+            return None
+        # header values are the raw bytes decoded as latin-1, compared as bytes
+        try:
+            token = req.headers.get('X-Token')
+            if token is not None:
+                return client if hmac.compare_digest(token.encode('latin-1'), self.secrets[client]) else None
+            signature = req.headers.get('X-Signature', '').encode('latin-1')
+            timestamp = req.headers.get('X-Timestamp', '')
+            now = time()
+            if not abs(now - float(timestamp)) <= self.MAX_SKEW:
+                return None
+        except (UnicodeEncodeError, ValueError):
+            return None
+        mac = self.macs[client].copy()
+        body_hash = hashlib.sha256(req.body).hexdigest()
+        mac.update(('%s\n%s\n%s\n%s' % (req.method, req.path_qs, timestamp, body_hash)).encode('latin-1', 'replace'))
+        if not hmac.compare_digest(mac.hexdigest().encode('ascii'), signature):
+            return None
+        self._forget_seen(now)
+        key = (client, signature)
+        if key in self.seen:
+            return None
+        self.seen.add(key)
+        self.seen_order.append((now + 2 * self.MAX_SKEW, key))
+        return client
+
+    def keep_seen(self, other):
+        """
+            Takes over the signatures seen by another authenticator (on a config reload)
+        """
+        self.seen = other.seen
+        self.seen_order = other.seen_order
+
+    def _forget_seen(self, now):
+        while self.seen_order and self.seen_order[0][0] < now:
+            self.seen.discard(self.seen_order.popleft()[1])
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def set_limits(self, rate, burst):
+        self._refill()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+    def take(self, count=1):
+        self._refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+
+class StatusBlock(object):
+    """
+        Worker status in shared memory: the worker writes it after each poll or command,
+        the http process reads it without a queue round trip or serial traffic.
+        A seqlock keeps reads consistent: the sequence is odd while the worker writes,
+        a reader retries until it sees the same even sequence before and after reading
+    """
+    STATES = ('disabled', 'enabled', 'accept', 'hold')
+    SEQ = struct.Struct('<I')
+    SEQ_MASK = 0xffffffff  # the sequence wraps around, 2 ** 32 is even so the parity is kept
+    # state, cashbox present, last status, last param, polls, events, update time
+    DATA = struct.Struct('<BBHiQQd')
+    READ_TRIES = 100
+
+    def __init__(self):
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(create=True, size=self.SEQ.size + self.DATA.size)
+        self.shm.buf[:self.shm.size] = bytes(self.shm.size)
+        self.owner = os.getpid()
+        self.closed = False
+
+    def write(self, state, cashbox, last_status, last_param, polls, events):
+        buf = self.shm.buf
+        seq = self.SEQ.unpack_from(buf, 0)[0]
+        if seq & 1:
+            # a writer died halfway
+            seq += 1
+        self.SEQ.pack_into(buf, 0, (seq + 1) & self.SEQ_MASK)
+        self.DATA.pack_into(buf, self.SEQ.size, self.STATES.index(state), cashbox, last_status or 0,
+                            last_param if isinstance(last_param, int) else -1, polls, events, time())
+        self.SEQ.pack_into(buf, 0, (seq + 2) & self.SEQ_MASK)
+
+    def read(self):
+        """
+            Returns the status dict, None if no consistent snapshot could be read
+        """
+        buf = self.shm.buf
+        for i in range(self.READ_TRIES):
+            seq = self.SEQ.unpack_from(buf, 0)[0]
+            if seq & 1:
+                sleep(0.0001)
+                continue
+            data = self.DATA.unpack_from(buf, self.SEQ.size)
+            if self.SEQ.unpack_from(buf, 0)[0] == seq:
+                break
+        else:
+            return None
+        state, cashbox, last_status, last_param, polls, events, updated = data
+        if not updated:
+            # never written
+            return {'state': 'unknown'}
+        return {
+            'state': self.STATES[state],
+            'enabled': self.STATES[state] != 'disabled',
+            'hold': self.STATES[state] == 'hold',
+            'cashbox_present': bool(cashbox),
+            'last_status': last_status or None,
+            'last_param': None if last_param < 0 else last_param,
+            'polls': polls,
+            'events': events,
+            'updated': updated,
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.shm.close()
+        if os.getpid() == self.owner:
+            self.shm.unlink()
+
+
 class SerialMock(object):
-    POLL_CMD = ('7f0001071188'.decode('hex'), '7f8001071202'.decode('hex'))
+    POLL_CMD = (bytes.fromhex('7f0001071188'), bytes.fromhex('7f8001071202'))
 
     def __init__(self, *args, **kwargs):
-        self.response = ''
+        self.response = b''
         self.poll_count = 0
-        self.sent = ''
+        self.sent = b''
 
     def write(self, data):
         self.sent = data
         if data in self.POLL_CMD:
             self.poll_count += 1
             if self.poll_count == 2:
-                self.response = '7f8003f0ef00cfca'
+                self.response = bytes.fromhex('7f8003f0ef00cfca')
                 return
             if self.poll_count == 3:
-                self.response = '7f8003f0ef04d44a'
+                self.response = bytes.fromhex('7f8003f0ef04d44a')
                 return
             if self.poll_count == 4:
-                self.response = '7f0004f0ee04cce0d6'
+                self.response = bytes.fromhex('7f0004f0ee04cce0d6')
                 return
-        self.response = '7f8001f02380'
+        self.response = bytes.fromhex('7f8001f02380')
 
     def read(self, count=None):
-        res = self.response[0:count*2]
-        self.response = self.response[count*2:]
-        return res.decode('hex')
+        res = self.response[0:count]
+        self.response = self.response[count:]
+        return res
 
-    def inWaiting(self):
+    @property
+    def in_waiting(self):
         return len(self.response)
 
 
 class App(object):
+    # commands in one /batch request
+    MAX_BATCH = 20
+
     def __init__(self, params):
         self.params = params
+        self.reload_requested = False
+        self.config = None
+        self.authenticator = None
+        self.buckets = {}
+        self._apply_config(params.config)
         self.child = None
         self.routes = []
+        from multiprocessing import Queue
         self.queue_request = Queue()
         self.queue_response = Queue()
+        self.status_block = StatusBlock()
+        atexit.register(self.status_block.close)
 
     @staticmethod
     def _template_to_regex(template):
@@ -106,30 +347,93 @@ class App(object):
         regex = '^%s$' % regex
         return regex
 
-    def add_route(self, template, view, **kwargs):
-        self.routes.append((re.compile(self._template_to_regex(template)), view, kwargs))
+    def add_route(self, template, view, rate_limited=True, **kwargs):
+        """
+            rate_limited: False, True (one token per request) or a function of the request
+            returning the number of tokens it takes
+        """
+        self.routes.append((re.compile(self._template_to_regex(template)), view, rate_limited, kwargs))
 
     def __call__(self, environ, start_response):
         if not self.child or not self.child.is_alive():
+            from multiprocessing import Process
             self.child = Process(
                 target=note_acceptor_worker,
-                args=(self.queue_request, self.queue_response, self.params)
+                args=(self.queue_request, self.queue_response, self.params, self.status_block)
             )
             self.child.daemon = True
             self.child.start()
+        from webob import Request, exc
         req = Request(environ)
-        for regex, controller, kwvars in self.routes:
+        for regex, controller, rate_limited, kwvars in self.routes:
             match = regex.match(req.path_info)
             if match:
+                if req.method == 'OPTIONS':
+                    # CORS preflight, browsers send it without the auth headers
+                    start_response('204 No Content', PREFLIGHT_HEADERS[:])
+                    return []
+                client = req.remote_addr
+                if self.authenticator:
+                    client = self.authenticator.check(req)
+                    if client is None:
+                        return exc.HTTPUnauthorized(headers=RESP_HEADERS[:])(environ, start_response)
+                tokens = rate_limited(req) if callable(rate_limited) else int(rate_limited)
+                if tokens and not self._take_token(client, tokens):
+                    return exc.HTTPTooManyRequests(headers=RESP_HEADERS[:])(environ, start_response)
                 req.urlvars = match.groupdict()
                 req.urlvars.update(kwvars)
-                res = json.dumps(controller(req))
+                res = json.dumps(controller(req)).encode('utf8')
                 headers = RESP_HEADERS[:]
                 headers.append(('Content-Length', str(len(res))),)
                 start_response('200 OK', headers)
                 return [res]
         return exc.HTTPNotFound()(environ, start_response)
 
+    def _apply_config(self, config):
+        # the replay cache and the clients' buckets survive a reload, else a reload would allow
+        # replaying the recent signatures and refill every bucket
+        authenticator = self.authenticator
+        if not config['auth_keys']:
+            authenticator = None
+        elif not authenticator or authenticator.keys != config['auth_keys']:
+            authenticator = Authenticator(config['auth_keys'])
+            if self.authenticator:
+                authenticator.keep_seen(self.authenticator)
+        limits = (config['rate_limit'], config['rate_burst'])
+        if self.config and limits != (self.config['rate_limit'], self.config['rate_burst']):
+            for bucket in self.buckets.values():
+                bucket.set_limits(*limits)
+        self.config = config
+        self.authenticator = authenticator
+
+    def _take_token(self, client, count=1):
+        if not self.config['rate_limit']:
+            return True
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) > 1000:
+                # forget the clients that have been idle long enough to refill
+                self.buckets = dict((k, b) for k, b in self.buckets.items() if not b.is_full())
+            bucket = self.buckets[client] = TokenBucket(self.config['rate_limit'], self.config['rate_burst'])
+        return bucket.take(count)
+
+    def request_reload(self, signum, frame):
+        # the queue must not be used from a signal handler, the reload is done between requests
+        self.reload_requested = True
+
+    def reload_config(self):
+        self.reload_requested = False
+        try:
+            config = load_config(self.params.config_file)
+        except (IOError, ValueError) as e:
+            # the running config is kept as a whole
+            sys.stderr.write('config reload failed: %s\n' % e)
+            return
+        self._apply_config(config)
+        # the worker is respawned with params.config
+        self.params.config = config
+        self.queue_request.put({'cmd': 'config', 'config': config})
+
     def index(self, req):
         return 'ok'
 
@@ -138,6 +442,26 @@ class App(object):
         self.queue_request.put({'cmd': cmd})
         return 'ok'
 
+    @staticmethod
+    def _batch_cmds(req):
+        return [cmd for cmd in req.params.get('cmds', '').split(',') if cmd]
+
+    def batch_tokens(self, req):
+        # each command of a batch reaches the serial line, so each one takes a token
+        return max(1, len(self._batch_cmds(req)))
+
+    def batch_cmd(self, req):
+        cmds = self._batch_cmds(req)
+        if not cmds:
+            return 'no commands'
+        if len(cmds) > self.MAX_BATCH:
+            return 'too many commands'
+        self.queue_request.put({'cmd': 'batch', 'cmds': cmds})
+        return 'ok'
+
+    def status(self, req):
+        return self.status_block.read()
+
     def poll(self, req):
         data = []
         while True:
@@ -148,6 +472,7 @@ class App(object):
         return data
 
     def print_check(self, req):
+        import datetime
         data = {
             'date': datetime.datetime.now().strftime('%d.%m.%Y'),
         }
@@ -157,9 +482,13 @@ class App(object):
         except:
             return 'input data error'
 
-        filename = '%s%s' % (CHECKS_DIR, data['order_id'])
+        order_id = data['order_id']
+        # order_id comes from the request: a plain file name only, never a path
+        if not order_id or order_id in ('.', '..') or os.path.basename(order_id) != order_id:
+            return 'input data error'
+        filename = os.path.join(self.config['checks_dir'], order_id)
         try:
-            f = open(filename, 'w+')
+            f = open(filename, 'wb+')
         except:
             return 'error save the check to disk'
 
@@ -171,9 +500,12 @@ class App(object):
             f.close()
 
         try:
+            import cups
             conn = cups.Connection()
             printers = conn.getPrinters()
-            printer_name = printers.keys()[0]
+            printer_name = self.config['printer_name']
+            if printer_name not in printers:
+                printer_name = list(printers)[0]
             conn.printFile(printer_name, filename, 'Python_Status_print', {})
         except:
             return 'check printing error'
@@ -181,15 +513,35 @@ class App(object):
         return 'ok'
 
 
-def note_acceptor_worker(queue_request, queue_response, params):
+class Journal(object):
+    """
+        Appends the acceptor events to a file, one json object per line (see essp_api.report)
+    """
+    def __init__(self, filename):
+        import socket
+        self.device = socket.gethostname()
+        self.file = open(filename, 'a', 1)
+
+    def write(self, event):
+        event = dict(event, time=time(), device=self.device)
+        self.file.write(json.dumps(event) + '\n')
+
+
+def note_acceptor_worker(queue_request, queue_response, params, status_block=None):
+    import serial
+    import logging
+    from essp_api import EsspApi, ChannelConfig
+    from essp_api.report import RejectStats
     verbose = params.verbose
     if params.test:
         serial.Serial = SerialMock
     lh = logging.FileHandler(params.logfile) if params.daemon else logging.StreamHandler(sys.stdout)
     verbose = verbose and verbose > 1
-    essp = EsspApi('/dev/ttyACM0', logger_handler=lh, verbose=verbose)
+    config = dict(params.config)
+    essp = EsspApi(config['serialport'], logger_handler=lh, verbose=verbose)
     logger = essp.get_logger()
     logger.info('[WORKER] Start')
+    journal = Journal(params.journal) if params.journal else None
     cmds = {
         'sync': lambda: essp.sync,
         'reset': lambda: essp.reset,
@@ -200,52 +552,112 @@ def note_acceptor_worker(queue_request, queue_response, params):
         'display_off': lambda: essp.display_off,
     }
     essp_state = 'disabled'
+    cashbox_present = True
+    last_status = last_param = None
+    polls = events = 0
+    reject_stats = RejectStats()
+    fetch_reject = False
     while True:
         try:
             data = queue_request.get(block=False)
         except:
             pass
         else:
-            logger.info('[WORKER] command: %s' % data['cmd'])
-            cmd = data['cmd']
-            res = {'cmd': cmd, 'result': False}
-            if cmd == 'test':
-                res['result'] = True
-                queue_response.put(res)
-                continue
-            if cmd in ('start', 'reset', 'disable'):
-                if essp_state == 'hold':
-                    essp.reject_note()
-                essp_state = 'disabled'
-            elif cmd in ('enable',):
-                if essp_state == 'disabled':
-                    essp_state = 'enabled' if HOLD_AND_WAIT_ACCEPT_CMD else 'accept'
-            if cmd in cmds:
-                res['result'] = cmds[cmd]()()
-            elif cmd == 'start':
-                res['result'] = bool(essp.sync() and essp.enable_higher_protocol() and essp.disable() and
-                                     essp.set_inhibits(essp.easy_inhibit([1, 1, 1, 1, 1, 1, 1]), '0'))
-            elif cmd == 'accept':
-                if essp_state == 'hold':
-                    essp_state = 'accept'
+            batch = data['cmds'] if data['cmd'] == 'batch' else [data['cmd']]
+            results = []
+            for cmd in batch:
+                logger.info('[WORKER] command: %s' % cmd)
+                if results and cmd == results[-1]['cmd'] and cmd in EsspApi.coalesced_commands:
+                    results.append(results[-1])
+                    continue
+                res = {'cmd': cmd, 'result': False}
+                results.append(res)
+                if cmd == 'test':
                     res['result'] = True
-            queue_response.put(res)
+                    continue
+                if cmd == 'reject_stats':
+                    res['result'] = reject_stats.report()
+                    continue
+                if cmd == 'config' and data.get('config'):
+                    new_config = data['config']
+                    if new_config['serialport'] != config['serialport']:
+                        logger.warning('[WORKER] The serial port change needs a restart')
+                    new_config = dict(new_config, serialport=config['serialport'])
+                    inhibits_changed = new_config['inhibits'] != config['inhibits']
+                    config = new_config
+                    res['result'] = True
+                    if inhibits_changed:
+                        channels = ChannelConfig([])
+                        channels.set_flags(config['inhibits'])
+                        res['result'] = essp.set_channel_inhibits(channels)
+                    logger.info('[WORKER] config reloaded')
+                    continue
+                if cmd in ('start', 'reset', 'disable'):
+                    if essp_state == 'hold':
+                        essp.reject_note()
+                    essp_state = 'disabled'
+                elif cmd in ('enable',):
+                    if essp_state == 'disabled':
+                        essp_state = 'enabled' if config['hold_and_wait_accept_cmd'] else 'accept'
+                if cmd in cmds:
+                    res['result'] = cmds[cmd]()()
+                elif cmd == 'start':
+                    channels = ChannelConfig([])
+                    channels.set_flags(config['inhibits'])
+                    res['result'] = bool(essp.sync() and essp.enable_higher_protocol() and essp.disable() and
+                                         essp.set_channel_inhibits(channels))
+                elif cmd == 'accept':
+                    if essp_state == 'hold':
+                        essp_state = 'accept'
+                        res['result'] = True
+            if data['cmd'] == 'batch':
+                queue_response.put({'cmd': 'batch', 'result': results})
+            else:
+                queue_response.put(results[0])
+            if status_block:
+                status_block.write(essp_state, cashbox_present, last_status, last_param, polls, events)
             continue
+        if fetch_reject:
+            # the reason of the previous poll's reject is asked along with this poll
+            fetch_reject = False
+            reason = essp.last_reject()
+            if reason is None:
+                # not counted: a failed fetch is no reject reason
+                logger.warning('[WORKER] failed to get the reject reason')
+            else:
+                reject_stats.add_rejected(reason)
+                logger.info('[WORKER] reject reason: %s' % EsspApi.reject_reason(reason))
+                queue_response.put({'cmd': 'reject', 'reason': reason, 'text': EsspApi.reject_reason(reason)})
+                if journal:
+                    journal.write({'reason': reason})
         if essp_state in ('enabled', 'accept'):
+            polls += 1
             for event in essp.poll():
                 status = event['status']
                 param = event['param']
                 if status == EsspApi.DISABLED:
                     continue
+                events += 1
+                last_status, last_param = status, param
                 if status == EsspApi.READ_NOTE:
                     logger.info('[WORKER] read note %s' % (param if param else 'unknown yet'))
                     if event['param'] and essp_state == 'enabled':
                         essp_state = 'hold'
                         essp.hold()
+                elif status == EsspApi.CREDIT_NOTE:
+                    reject_stats.add_accepted()
+                elif status == EsspApi.NOTE_REJECTED:
+                    fetch_reject = True
+                elif status in (EsspApi.CASH_BOX_REMOVED, EsspApi.CASH_BOX_REPLACED):
+                    cashbox_present = status == EsspApi.CASH_BOX_REPLACED
                 queue_response.put({'cmd': 'poll', 'status': status, 'param': param})
+                if journal:
+                    journal.write({'status': status, 'param': param})
         if essp_state == 'hold':
             essp.hold()
-        sleep(1)
+        if status_block:
+            status_block.write(essp_state, cashbox_present, last_status, last_param, polls, events)
+        sleep(config['poll_interval'])
 
         if os.getppid() == 1:
             logger.info('[WORKER] Parent process has terminated')
@@ -253,6 +665,7 @@ def note_acceptor_worker(queue_request, queue_response, params):
 
 
 def http_server_worker(params):
+    from wsgiref.simple_server import make_server
     app = App(params)
     app.add_route('/', app.index)
     app.add_route('/{cmd:sync|reset|enable|disable|hold|accept}', app.simple_cmd)
@@ -261,16 +674,29 @@ def http_server_worker(params):
     app.add_route('/poll', app.poll)
     app.add_route('/start', app.simple_cmd, cmd='start')
     app.add_route('/test', app.simple_cmd, cmd='test')
+    app.add_route('/batch', app.batch_cmd, rate_limited=app.batch_tokens)
+    app.add_route('/reject_stats', app.simple_cmd, cmd='reject_stats')
     app.add_route('/print', app.print_check)
+    app.add_route('/status', app.status, rate_limited=False)
     httpd = make_server(params.host, int(params.port), app)
     try:
-        httpd.serve_forever()
+        signal(SIGHUP, app.request_reload)
+        # exit normally on SIGTERM so the atexit handlers remove the pidfile and the status block
+        signal(SIGTERM, lambda signum, frame: sys.exit(0))
+        httpd.timeout = 1
+        while True:
+            httpd.handle_request()
+            if app.reload_requested:
+                app.reload_config()
     except KeyboardInterrupt:
         httpd.server_close()
 
 
 class Daemon:
     def __init__(self, params):
+        params.config = load_config(getattr(params, 'config_file', None))
+        if not getattr(params, 'logfile', None):
+            params.logfile = params.config['log_file']
         logfile = params.logfile if params.daemon else None
         self.stdin = '/dev/null'
         self.stdout = logfile
@@ -283,7 +709,7 @@ class Daemon:
             pid = os.fork()
             if pid > 0:
                 sys.exit(0)
-        except OSError, e:
+        except OSError as e:
             sys.stderr.write('fork #1 failed: %d (%s)\n' % (e.errno, e.strerror))
             sys.exit(1)
 
@@ -295,29 +721,30 @@ class Daemon:
             pid = os.fork()
             if pid > 0:
                 sys.exit(0)
-        except OSError, e:
+        except OSError as e:
             sys.stderr.write('fork #2 failed: %d (%s)\n' % (e.errno, e.strerror))
             sys.exit(1)
 
         sys.stdout.flush()
         sys.stderr.flush()
-        si = file(self.stdin, 'r')
-        so = file(self.stdout, 'a+')
-        se = file(self.stderr, 'a+', 0)
+        si = open(self.stdin, 'r')
+        so = open(self.stdout, 'a+')
+        se = open(self.stderr, 'ab+', 0)
         os.dup2(si.fileno(), sys.stdin.fileno())
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
         atexit.register(self.delpid)
         pid = str(os.getpid())
-        file(self.params.pidfile, 'w+').write("%s\n" % pid)
+        with open(self.params.pidfile, 'w+') as f:
+            f.write('%s\n' % pid)
 
     def delpid(self):
         os.remove(self.params.pidfile)
 
     def start(self):
         try:
-            pf = file(self.params.pidfile, 'r')
+            pf = open(self.params.pidfile, 'r')
             pid = int(pf.read().strip())
             pf.close()
         except IOError:
@@ -333,7 +760,7 @@ class Daemon:
 
     def stop(self):
         try:
-            pf = file(self.params.pidfile, 'r')
+            pf = open(self.params.pidfile, 'r')
             pid = int(pf.read().strip())
             pf.close()
         except IOError:
@@ -348,13 +775,13 @@ class Daemon:
             while 1:
                 os.kill(pid, SIGTERM)
                 sleep(0.1)
-        except OSError, err:
+        except OSError as err:
             err = str(err)
             if err.find('No such process') > 0:
                 if os.path.exists(self.params.pidfile):
                     os.remove(self.params.pidfile)
             else:
-                print str(err)
+                print(err)
                 sys.exit(1)
 
     def restart(self):
@@ -384,27 +811,42 @@ def run(params):
     daemon = Daemon(params)
     daemon.run()
 
-daemon_params = argparse.ArgumentParser(add_help=False)
-daemon_params.add_argument('-p', '--pidfile', default='/tmp/kiosk_server.pid', help='Pid for daemon')
-daemon_params.add_argument('-l', '--logfile', default=LOG_FILE, help='Logfile')
-run_params = argparse.ArgumentParser(add_help=False)
-run_params.add_argument('-t', '--test', help='Test', action='count')
-run_params.add_argument('-v', '--verbose', action='count', help='-vv: very verbose')
-run_params.add_argument('-P', '--port', default=BIND_PORT, help='Port to serve on (default %s)' % BIND_PORT)
-run_params.add_argument('-H', '--host', default=BIND_ADDRESS,
-                        help='Host to serve on (default %s; 0.0.0.0 to make public)' % BIND_ADDRESS)
-
-parser = argparse.ArgumentParser(description='Kiosk http server. Help: %(prog)s start -h')
-p = parser.add_subparsers()
-sp_start = p.add_parser('start', parents=[run_params, daemon_params], help='Starts %(prog)s daemon')
-sp_stop = p.add_parser('stop', parents=[daemon_params], help='Stops %(prog)s daemon')
-sp_restart = p.add_parser('restart', parents=[daemon_params], help='Restarts %(prog)s daemon')
-sp_run = p.add_parser('run', parents=[run_params], help='Run in foreground')
-
-sp_start.set_defaults(func=start, daemon=True)
-sp_stop.set_defaults(func=stop, daemon=True)
-sp_restart.set_defaults(func=restart, daemon=True)
-sp_run.set_defaults(func=run, daemon=False)
-
-args = parser.parse_args()
-args.func(args)
+
+def main():
+    daemon_params = argparse.ArgumentParser(add_help=False)
+    daemon_params.add_argument('-p', '--pidfile', default='/tmp/kiosk_server.pid', help='Pid for daemon')
+    daemon_params.add_argument('-l', '--logfile', default=None, help='Logfile (default %s)' % LOG_FILE)
+    run_params = argparse.ArgumentParser(add_help=False)
+    run_params.add_argument('-t', '--test', help='Test', action='count')
+    run_params.add_argument('-v', '--verbose', action='count', help='-vv: very verbose')
+    run_params.add_argument('-P', '--port', default=BIND_PORT, help='Port to serve on (default %s)' % BIND_PORT)
+    run_params.add_argument('-c', '--config', dest='config_file', default=None,
+                            help='Json config file, reloaded on SIGHUP')
+    run_params.add_argument('-j', '--journal', default=None, help='Append the acceptor events to this file')
+    run_params.add_argument('-H', '--host', default=BIND_ADDRESS,
+                            help='Host to serve on (default %s; 0.0.0.0 to make public)' % BIND_ADDRESS)
+
+    parser = argparse.ArgumentParser(description='Kiosk http server. Help: %(prog)s start -h')
+    p = parser.add_subparsers(dest='command')
+    p.required = True
+    sp_start = p.add_parser('start', parents=[run_params, daemon_params], help='Starts %(prog)s daemon')
+    sp_stop = p.add_parser('stop', parents=[daemon_params], help='Stops %(prog)s daemon')
+    sp_restart = p.add_parser('restart', parents=[run_params, daemon_params], help='Restarts %(prog)s daemon')
+    sp_run = p.add_parser('run', parents=[run_params], help='Run in foreground')
+
+    sp_start.set_defaults(func=start, daemon=True)
+    sp_stop.set_defaults(func=stop, daemon=True)
+    sp_restart.set_defaults(func=restart, daemon=True)
+    sp_run.set_defaults(func=run, daemon=False)
+
+    args = parser.parse_args()
+    # the daemon chdirs to /: the config is read again on SIGHUP, the journal is opened by the worker
+    if getattr(args, 'config_file', None):
+        args.config_file = os.path.abspath(args.config_file)
+    if getattr(args, 'journal', None):
+        args.journal = os.path.abspath(args.journal)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,13 @@ setup(
     author_email='max.begemot -at- gmail.com',
     license='thinking..',
     classifiers=[
-        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 3',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     keywords='essp banknote validators',
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
-    install_requires=['pyserial', 'webob'],
+    python_requires='>=3.8',
+    install_requires=['pyserial>=3.0', 'webob'],
+    extras_require={'numpy': ['numpy']},
     tests_require=['nose'],
 )
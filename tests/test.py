@@ -1,41 +1,55 @@
-from essp_api import EsspApi
+from essp_api import EsspApi, ChannelConfig, PayoutInventory
+from essp_api.api import ESSPException
+from essp_api.report import aggregate, RejectStats
+import os
+import hmac
+import json
+import time
+import tempfile
+import hashlib
+import argparse
 import unittest
 import serial
+from webob import Request
+import kiosk_server
 
 
 class SerialMock(object):
-    POLL_CMD = ('7f0001071188'.decode('hex'), '7f8001071202'.decode('hex'))
+    POLL_CMD = (bytes.fromhex('7f0001071188'), bytes.fromhex('7f8001071202'))
 
     def __init__(self, *args, **kwargs):
-        self.response = ''
+        self.response = b''
         self.poll_count = 0
-        self.sent = ''
+        self.sent = b''
+        self.write_count = 0
 
     def write(self, data):
         self.sent = data
+        self.write_count += 1
         if data in self.POLL_CMD:
             self.poll_count += 1
             step = self.poll_count % 10
             if step == 2:
                 # a note is in the process of being scanned
-                self.response = '7f8003f0ef00cfca'
+                self.response = bytes.fromhex('7f8003f0ef00cfca')
                 return
             if step == 3:
                 # valid note has been scanned, 4 channel
-                self.response = '7f8003f0ef04d44a'
+                self.response = bytes.fromhex('7f8003f0ef04d44a')
                 return
             if step == 4:
                 # a note has passed through the device
-                self.response = '7f0004f0ee04cce0d6'
+                self.response = bytes.fromhex('7f0004f0ee04cce0d6')
                 return
-        self.response = '7f8001f02380'
+        self.response = bytes.fromhex('7f8001f02380')
 
     def read(self, count=None):
-        res = self.response[0:count*2]
-        self.response = self.response[count*2:]
-        return res.decode('hex')
+        res = self.response[0:count]
+        self.response = self.response[count:]
+        return res
 
-    def inWaiting(self):
+    @property
+    def in_waiting(self):
         return len(self.response)
 
 
@@ -47,7 +61,7 @@ class TestESSP(unittest.TestCase):
         p = EsspApi('')
         self.assertTrue(p.sync())
         self.assertIsInstance(p.poll(), list)
-        self.assertIn(''.join(['%02x' % ord(c) for c in p._serial.sent]), ('7f8001071202', '7f0001071188'))
+        self.assertIn(p._serial.sent.hex(), ('7f8001071202', '7f0001071188'))
         res = p.poll()[0]
         self.assertEqual(res['status'], p.READ_NOTE)
         self.assertEqual(res['param'], 0)
@@ -59,6 +73,278 @@ class TestESSP(unittest.TestCase):
         self.assertEqual(res['param'], 4)
         self.assertEqual(p.easy_inhibit([1, 0, 1, 0, 1, 1, 1, 1]), 'f5')
 
+    def test_packet(self):
+        p = EsspApi('')
+        self.assertEqual(p._crc(bytes.fromhex('800107')), bytes.fromhex('1202'))
+        self.assertTrue(p.set_inhibits(0x7f, '0'))
+        self.assertEqual(p._serial.sent[4:6], b'\x7f\x7f')
+        self.assertEqual(len(p._serial.sent), 9)
+
+    def test_batch(self):
+        p = EsspApi('')
+        self.assertTrue(p.sync())
+        count = p._serial.write_count
+        res = p.batch(['hold', 'hold', 'hold', ('set_inhibits', 'ff', '0'), 'enable', 'enable', 'unknown'])
+        self.assertEqual(res, [True, True, True, True, True, True, False])
+        self.assertEqual(p._serial.write_count - count, 3)
+
+    def test_channel_config(self):
+        config = ChannelConfig([1, 5, 10, 20], multiplier=100)
+        self.assertEqual(config.channels, 4)
+        self.assertEqual(config.value(3), 1000)
+        self.assertEqual(config.value(0), 0)
+        self.assertEqual(config.value(9), 0)
+        self.assertEqual(config.value(-1), 0)
+        self.assertEqual(config.total([-1, 1]), 100)
+        self.assertRaises(ValueError, config.enable, 0)
+        self.assertRaises(ValueError, config.inhibit, 17)
+        self.assertEqual(config.total([1, 2, 2, 4, 0]), 3100)
+        self.assertEqual(config.inhibit_bytes(), (0x0f, 0))
+        config.set_flags([1, 0, 1, 0, 1, 1, 1, 1])
+        self.assertEqual('%02x' % config.inhibit_bytes()[0], EsspApi.easy_inhibit([1, 0, 1, 0, 1, 1, 1, 1]))
+        config.inhibit(1)
+        config.enable(2, 12)
+        self.assertFalse(config.is_enabled(1))
+        self.assertTrue(config.is_enabled(2))
+        self.assertEqual(config.inhibit_bytes(), (0xf6, 0x08))
+        p = EsspApi('')
+        self.assertTrue(p.set_channel_inhibits(config))
+
+    def test_report(self):
+        events = [
+            {'time': 3600, 'device': 'k1', 'status': EsspApi.CREDIT_NOTE, 'param': 2},
+            {'time': 3700, 'device': 'k1', 'status': EsspApi.CREDIT_NOTE, 'param': 4},
+            {'time': 7300, 'device': 'k2', 'status': EsspApi.CREDIT_NOTE, 'param': 2},
+            {'time': 7300, 'device': 'k2', 'status': EsspApi.READ_NOTE, 'param': 2},
+            {'time': 7400, 'device': 'k2', 'status': EsspApi.NOTE_REJECTED, 'param': None},
+            {'time': 7400, 'device': 'k2', 'reason': 0x0D},
+            {'time': 7500, 'device': 'k1', 'status': EsspApi.FRAUD_ATTEMPT, 'param': 1},
+        ]
+        channels = ChannelConfig([1, 5, 10, 20])
+        for chunk_size in (None, 3):
+            res = aggregate(events, channels, chunk_size=chunk_size)
+            self.assertEqual(res['events'], 7)
+            self.assertEqual(res['channels'][2], {'count': 2, 'total': 10})
+            self.assertEqual(res['devices']['k1'], {'count': 2, 'total': 25})
+            self.assertEqual(res['intervals'][3600], {'count': 2, 'total': 25})
+            self.assertEqual(res['intervals'][7200], {'count': 1, 'total': 5})
+            self.assertEqual(res['rejected'], 1)
+            self.assertEqual(res['reject_reasons'], {0x0D: 1})
+            self.assertEqual(res['frauds'], {'k1': 1})
+
+    def test_reject_stats(self):
+        stats = RejectStats(window=4)
+        stats.add_rejected(0x16)
+        stats.add_accepted()
+        stats.add_rejected(0x0D)
+        stats.add_rejected(0x0D)
+        self.assertEqual(stats.reject_rate(), 0.75)
+        stats.add_accepted()
+        res = stats.report()
+        self.assertEqual(res['totals'], {'Slot Fail 1': 1, 'Mechanism Slow / Stalled': 2})
+        self.assertEqual(res['recent'], {'Mechanism Slow / Stalled': 2})
+        self.assertEqual(res['reject_rate'], 0.5)
+        self.assertEqual(EsspApi.reject_reason(0x40), 'Unknown reason 0x40')
+        p = EsspApi('')
+        p._send = lambda commands: []
+        self.assertIsNone(p.last_reject())
+
+    def test_payout(self):
+        p = EsspApi('')
+        sent = []
+
+        def send(commands):
+            sent.append(bytes(p._encode(commands)))
+            return responses.pop(0)
+
+        p._send = send
+        responses = [
+            [2, 3, 0, 0x88, 0x13, 0, 0, 0x45, 0x55, 0x52, 0, 0, 0xd0, 0x07, 0, 0, 0x45, 0x55, 0x52],
+            [0xf0],
+            [0xda, 1, 0x58, 0x1b, 0, 0, 0x45, 0x55, 0x52, 0xd2, 1, 0x58, 0x1b, 0, 0, 0x45, 0x55, 0x52, 0xe8],
+        ]
+        levels = p.get_all_levels()
+        self.assertEqual(levels, [{'value': 5000, 'country': 'EUR', 'level': 3},
+                                  {'value': 2000, 'country': 'EUR', 'level': 0}])
+        self.assertTrue(p.payout_amount(7000, 'EUR'))
+        self.assertEqual(sent[-1], bytes.fromhex('33581b0000455552') + b'\x58')
+        events = p.poll()
+        self.assertEqual(events[0], {'status': p.DISPENSING, 'param': [(7000, 'EUR')]})
+        self.assertEqual(events[1], {'status': p.DISPENSED, 'param': [(7000, 'EUR')]})
+        self.assertEqual(events[2], {'status': p.DISABLED, 'param': None})
+
+        inventory = PayoutInventory(ChannelConfig([5, 10, 20], 100), levels)
+        inventory.update([{'status': p.CREDIT_NOTE, 'param': 3}, {'status': p.NOTE_STORED_IN_PAYOUT, 'param': None}])
+        self.assertEqual(inventory.levels, {5000: 3, 2000: 1})
+        inventory.update(events)
+        self.assertEqual(inventory.levels, {5000: 2})
+        self.assertFalse(inventory.stale)
+        inventory.update([{'status': p.DISPENSED, 'param': [(3000, 'EUR')]}])
+        self.assertTrue(inventory.stale)
+
+        # the device doesn't answer: the inventory stays stale
+        def send_error(commands):
+            raise ESSPException()
+
+        p._send = send_error
+        self.assertIsNone(p.get_all_levels())
+        self.assertIsNone(p.get_denomination_level(5000, 'EUR'))
+        p._send = lambda commands: [3]
+        self.assertIsNone(p.get_denomination_level(5000, 'EUR'))
+        p._send = lambda commands: [0, 0]
+        self.assertEqual(p.get_denomination_level(5000, 'EUR'), 0)
+        p._send = send_error
+        self.assertFalse(inventory.refresh(p))
+        self.assertTrue(inventory.stale)
+        self.assertEqual(inventory.levels, {5000: 2})
+
+
+class TestKioskServer(unittest.TestCase):
+    @staticmethod
+    def signed(path, timestamp, key=b's3cret', method='GET', body=b''):
+        message = '%s\n%s\n%s\n%s' % (method, path, timestamp, hashlib.sha256(body).hexdigest())
+        signature = hmac.new(key, message.encode(), hashlib.sha256).hexdigest()
+        req = Request.blank(path, method=method, headers={
+            'X-Client': 'hq', 'X-Timestamp': str(timestamp), 'X-Signature': signature})
+        if body:
+            req.content_type = 'application/x-www-form-urlencoded'
+            req.body = body
+        return req
+
+    def test_authenticator(self):
+        auth = kiosk_server.Authenticator({'hq': 's3cret'})
+        self.assertEqual(auth.check(Request.blank('/poll', headers={'X-Client': 'hq', 'X-Token': 's3cret'})), 'hq')
+        self.assertIsNone(auth.check(Request.blank('/poll', headers={'X-Client': 'hq', 'X-Token': 'bad'})))
+        self.assertIsNone(auth.check(Request.blank('/poll', headers={'X-Client': 'x', 'X-Token': 's3cret'})))
+        self.assertIsNone(auth.check(Request.blank('/poll')))
+        now = int(time.time())
+        self.assertEqual(auth.check(self.signed('/reset?a=1', now)), 'hq')
+        # replayed
+        self.assertIsNone(auth.check(self.signed('/reset?a=1', now)))
+        self.assertIsNone(auth.check(self.signed('/reset', now, key=b'other')))
+        self.assertIsNone(auth.check(self.signed('/reset', now - auth.MAX_SKEW - 10)))
+        self.assertIsNone(auth.check(self.signed('/reset', 'nan')))
+        self.assertEqual(auth.check(self.signed('/reset', now - auth.MAX_SKEW + 10)), 'hq')
+        # the body is signed
+        body = b'order_id=1&credit=10&fio=A'
+        self.assertEqual(auth.check(self.signed('/print', now, method='POST', body=body)), 'hq')
+        req = self.signed('/print', now + 2, method='POST', body=body)
+        req.body = b'order_id=1&credit=1000&fio=A'
+        self.assertIsNone(auth.check(req))
+        req = self.signed('/reset', now + 1)
+        req.headers['X-Signature'] = '\xff\xff'
+        self.assertIsNone(auth.check(req))
+        req.headers['X-Signature'] = '\u20ac'
+        self.assertIsNone(auth.check(req))
+
+    def test_token_bucket(self):
+        clock = [100.0]
+        monotonic = kiosk_server.monotonic
+        kiosk_server.monotonic = lambda: clock[0]
+        try:
+            bucket = kiosk_server.TokenBucket(2, 3)
+            self.assertEqual([bucket.take() for i in range(4)], [True, True, True, False])
+            clock[0] += 0.5
+            self.assertEqual([bucket.take() for i in range(2)], [True, False])
+            self.assertFalse(bucket.is_full())
+            clock[0] += 10
+            self.assertTrue(bucket.is_full())
+        finally:
+            kiosk_server.monotonic = monotonic
+
+    def test_app(self):
+        config = dict(kiosk_server.DEFAULT_CONFIG, auth_keys={'hq': 's3cret'}, rate_limit=1, rate_burst=2)
+        app = kiosk_server.App(argparse.Namespace(config=config))
+        self.addCleanup(app.status_block.close)
+
+        class Child(object):
+            @staticmethod
+            def is_alive():
+                return True
+
+        app.child = Child()
+        app.add_route('/test', app.index)
+        app.add_route('/status', app.status, rate_limited=False)
+        res = Request.blank('/test', method='OPTIONS').get_response(app)
+        self.assertEqual(res.status_int, 204)
+        self.assertIn('X-Signature', res.headers['Access-Control-Allow-Headers'])
+        res = Request.blank('/test').get_response(app)
+        self.assertEqual(res.status_int, 401)
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+        headers = {'X-Client': 'hq', 'X-Token': 's3cret'}
+        codes = [Request.blank('/test', headers=headers).get_response(app).status_int for i in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        res = Request.blank('/test', headers=headers).get_response(app)
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(Request.blank('/status', headers=headers).get_response(app).status_int, 200)
+
+        # every command of a batch takes a token
+        app.add_route('/batch', app.batch_cmd, rate_limited=app.batch_tokens)
+        app.buckets = {}
+        res = Request.blank('/batch?cmds=reset,sync,reset', headers=headers).get_response(app)
+        self.assertEqual(res.status_int, 429)
+        res = Request.blank('/batch?cmds=reset,sync', headers=headers).get_response(app)
+        self.assertEqual((res.status_int, res.json), (200, 'ok'))
+        self.assertEqual(app.queue_request.get(timeout=1), {'cmd': 'batch', 'cmds': ['reset', 'sync']})
+        app.config = dict(app.config, rate_limit=0)
+        cmds = ','.join(['sync'] * (app.MAX_BATCH + 1))
+        self.assertEqual(Request.blank('/batch?cmds=' + cmds, headers=headers).get_response(app).json,
+                         'too many commands')
+
+    def test_reload_config(self):
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        def write(data):
+            with open(filename, 'w') as f:
+                f.write(data if isinstance(data, str) else json.dumps(data))
+
+        write({'auth_keys': {'hq': 's3cret'}, 'poll_interval': 0.5})
+        params = argparse.Namespace(config_file=filename, config=kiosk_server.load_config(filename))
+        app = kiosk_server.App(params)
+        self.addCleanup(app.status_block.close)
+        config = params.config
+        for data in ([1, 2], {'auth_keys': ['hq']}, {'poll_interval': '1'}, {'inhibits': [1, 2]},
+                     {'hold_and_wait_accept_cmd': 1}, {'rate_limit': -1}, '{"broken'):
+            write(data)
+            self.assertRaises(ValueError, kiosk_server.load_config, filename)
+            app.reload_config()
+            self.assertIs(params.config, config)
+            self.assertIs(app.config, config)
+            self.assertTrue(app.queue_request.empty())
+        # the replay cache and the buckets are kept
+        now = int(time.time())
+        self.assertEqual(app.authenticator.check(self.signed('/reset', now)), 'hq')
+        app._take_token('hq', 5)
+        write({'auth_keys': {'hq': 's3cret', 'kiosk': 'other'}, 'rate_burst': 10})
+        app.reload_config()
+        self.assertEqual(app.authenticator.check(Request.blank('/', headers={'X-Client': 'kiosk', 'X-Token': 'other'})),
+                         'kiosk')
+        self.assertIsNone(app.authenticator.check(self.signed('/reset', now)))
+        self.assertLessEqual(app.buckets['hq'].tokens, 10)
+        self.assertEqual(app.buckets['hq'].burst, 10)
+        app.queue_request.get(timeout=1)
+        write({'poll_interval': 2})
+        app.reload_config()
+        self.assertEqual(params.config['poll_interval'], 2)
+        self.assertIsNone(app.authenticator)
+        self.assertEqual(app.queue_request.get(timeout=1)['config'], params.config)
+
+    def test_status_block(self):
+        block = kiosk_server.StatusBlock()
+        self.addCleanup(block.close)
+        self.assertEqual(block.read(), {'state': 'unknown'})
+        block.SEQ.pack_into(block.shm.buf, 0, block.SEQ_MASK - 1)
+        block.write('hold', True, EsspApi.READ_NOTE, 4, 2 ** 40, 7)
+        self.assertEqual(block.SEQ.unpack_from(block.shm.buf, 0)[0], 0)
+        res = block.read()
+        self.assertEqual((res['state'], res['hold'], res['last_param'], res['polls']), ('hold', True, 4, 2 ** 40))
+        block.write('disabled', False, None, [(5000, 'EUR')], 1, 1)
+        res = block.read()
+        self.assertEqual((res['enabled'], res['cashbox_present'], res['last_status'], res['last_param']),
+                         (False, False, None, None))
+
 
 if __name__ == '__main__':
     unittest.main()